@@ -1,135 +1,287 @@
 #!/usr/bin/env python3
 import sys
+import os
 import struct
+import hashlib
+import locale
+import shutil
+import tempfile
+
+_U32 = struct.Struct('<I')
+
+CACHE_DIR = os.path.expanduser('~/.cache/uvm_asm')
+# Меняется при изменении кодирования команд, чтобы не брать старые бинарники
+_CACHE_VERSION = b'5'
+
+def _cache_path(source):
+    digest = hashlib.blake2b(_CACHE_VERSION + b'\0' + source).hexdigest()
+    return os.path.join(CACHE_DIR, f'{digest}.bin')
+
+def _store_cache(cache_path, binary):
+    tmp = None
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=CACHE_DIR, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(binary)
+        os.replace(tmp, cache_path)
+    except OSError:
+        # Кэш необязателен, ошибка записи не мешает ассемблированию
+        if tmp is not None:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+
+def _parse_int(arg):
+    # int(x, 0) понимает и десятичные числа, и префиксы 0x/0o/0b
+    try:
+        return int(arg, 0)
+    except ValueError:
+        pass
+    # Десятичные числа с ведущими нулями (010, 007) int(x, 0) не принимает
+    try:
+        return int(arg, 10)
+    except ValueError:
+        return 0
+
+# Кодировщики пишут команду в буфер по смещению pos и возвращают её длину
+
+def _enc_loadc(buf, pos, args):
+    const, _, dest = args
+    A = 1
+    B = const
+    C = dest
+    
+    word = (A << 26) | (B << 6) | C
+    _U32.pack_into(buf, pos, word)
+    return 4
+
+def _enc_readm(buf, pos, args):
+    offset, src, dest, base = args
+    A = 21
+    B = offset
+    C = dest
+    D = base
+    
+    byte1 = (A << 2) | (B >> 7)
+    byte2 = ((B & 0x7F) << 1) | (C >> 2)
+    byte3 = ((C & 0x03) << 6) | (D << 3)
+    
+    buf[pos:pos+3] = bytes((byte1, byte2, byte3))
+    return 3
+
+def _enc_2byte(A, buf, pos, args):
+    # Общий формат WRITEM и POPCNT
+    src, dest, base = args
+    B = src
+    C = base
+    
+    byte1 = (A << 2) | (B >> 1)
+    byte2 = ((B & 0x01) << 7) | (C << 4)
+    
+    buf[pos:pos+2] = bytes((byte1, byte2))
+    return 2
+
+def _enc_writem(buf, pos, args):
+    return _enc_2byte(39, buf, pos, args)
+
+def _enc_popcnt(buf, pos, args):
+    return _enc_2byte(44, buf, pos, args)
+
+# Мнемоника -> (число аргументов, кодировщик, описание для тестового режима)
+_ENCODERS = {
+    'LOADC': (3, _enc_loadc,
+              lambda a: f"LOADC: R{a[2]} = {a[0]}"),
+    'READM': (4, _enc_readm,
+              lambda a: f"READM: R{a[2]} = mem[R{a[3]}+{a[0]}]"),
+    'WRITEM': (3, _enc_writem,
+               lambda a: f"WRITEM: mem[R{a[2]}] = R{a[0]}"),
+    'POPCNT': (3, _enc_popcnt,
+               lambda a: f"POPCNT: R{a[2]} = popcount(R{a[0]})"),
+}
+
+# Регистры, которые команда читает и записывает: args -> (reads, writes)
+_REG_USE = {
+    'LOADC': lambda args: ((), (args[2],)),
+    'READM': lambda args: ((args[3],), (args[2],)),
+    'WRITEM': lambda args: ((args[0], args[2]), ()),
+    'POPCNT': lambda args: ((args[0],), (args[2],)),
+}
+
+def _is_valid(instr):
+    _, mnemonic, args = instr
+    return mnemonic in _ENCODERS and len(args) == _ENCODERS[mnemonic][0]
+
+# Кодируемые поля команды: (индекс аргумента, граница). Значение вне границы
+# при кодировании попадает в соседние поля и меняет смысл команды
+_FIELDS = {
+    'LOADC': ((0, 1 << 20), (2, 8)),
+    'READM': ((0, 1 << 9), (2, 8), (3, 8)),
+    'WRITEM': ((0, 8), (2, 8)),
+    'POPCNT': ((0, 8), (2, 8)),
+}
+
+def _fits(instr):
+    """Все поля корректной команды кодируются без переполнения"""
+    _, mnemonic, args = instr
+    return all(0 <= args[i] < limit for i, limit in _FIELDS[mnemonic])
+
+def _reg_dead(reg, ir, start):
+    """Значение регистра перезаписывается раньше, чем читается"""
+    for j in range(start, len(ir)):
+        instr = ir[j]
+        if not _is_valid(instr):
+            continue  # ошибочные строки в бинарник не попадают
+        if not _fits(instr):
+            return False  # неизвестно, какие регистры команда задевает
+        reads, writes = _REG_USE[instr[1]](instr[2])
+        if reg in reads:
+            return False
+        if reg in writes:
+            return True
+    # Значения регистров видны после завершения программы
+    return False
+
+# Правило получает пару команд и возвращает (замена, регистр), где регистр
+# должен быть мёртв после пары (None — без условия), либо None
+
+def _fold_loadc_popcnt(first, second):
+    # LOADC k _ r; POPCNT r _ x  ->  LOADC popcount(k) _ x
+    line_num, _, (const, _, reg) = first
+    src, _, dest = second[2]
+    if src != reg:
+        return None
+    replacement = [(line_num, 'LOADC', [const.bit_count(), 0, dest])]
+    return replacement, (None if reg == dest else reg)
+
+def _fold_loadc_loadc(first, second):
+    # LOADC a _ r; LOADC b _ r  ->  LOADC b _ r
+    if first[2][2] != second[2][2]:
+        return None
+    return [second], None
+
+# (первая команда, вторая команда) -> правило свёртки
+_FOLD_RULES = {
+    ('LOADC', 'POPCNT'): _fold_loadc_popcnt,
+    ('LOADC', 'LOADC'): _fold_loadc_loadc,
+}
+
+def _optimize(ir):
+    """Свёртка констант и peephole-оптимизация промежуточного представления"""
+    out = []
+    for i, instr in enumerate(ir):
+        out.append(instr)
+        while len(out) >= 2:
+            first, second = out[-2], out[-1]
+            rule = _FOLD_RULES.get((first[1], second[1]))
+            if rule is None or not (_is_valid(first) and _is_valid(second)):
+                break
+            if not (_fits(first) and _fits(second)):
+                break
+            result = rule(first, second)
+            if result is None:
+                break
+            replacement, dead = result
+            if dead is not None and not _reg_dead(dead, ir, i + 1):
+                break
+            out[-2:] = replacement
+    return out
 
 def assemble(input_file, output_file, test_mode=False):
     try:
-        with open(input_file, 'r') as f:
-            lines = f.readlines()
+        with open(input_file, 'rb') as f:
+            source = f.read()
     except FileNotFoundError:
         print(f"Ошибка: файл '{input_file}' не найден!")
         print("Создайте файл test_program.asm")
         return
     
-    binary = bytearray()
-    
     print(f"Ассемблирование {input_file}...")
     
+    # В тестовом режиме нужен построчный вывод, поэтому кэш не используется
+    cache_path = None if test_mode else _cache_path(source)
+    if cache_path and os.path.exists(cache_path):
+        try:
+            shutil.copyfile(cache_path, output_file)
+        except OSError:
+            pass  # повреждённая запись кэша: ассемблируем заново
+        else:
+            print(f"\nСоздан файл: {output_file} ({os.path.getsize(output_file)} байт, из кэша)")
+            return
+    
+    # Кодировка локали, как у open() в текстовом режиме; нераспознанные
+    # байты заменяются, так как обычно это комментарии
+    encoding = locale.getpreferredencoding(False)
+    lines = source.decode(encoding, errors='replace').splitlines()
+    errors = 0
+    
+    # Проход 1: разбор строк в промежуточное представление
+    ir = []
     for line_num, line in enumerate(lines, 1):
-        line = line.strip()
-        
-        if not line or line.startswith(';'):
-            continue
-            
-        if ';' in line:
-            line = line.split(';')[0].strip()
-            
-        parts = line.split()
+        parts = line.partition(';')[0].split()
         if not parts:
             continue
             
         mnemonic = parts[0].upper()
-        args = []
-        
-        for arg in parts[1:]:
-            if arg.startswith('0x'):
-                args.append(int(arg[2:], 16))
-            else:
-                try:
-                    args.append(int(arg))
-                except:
-                    args.append(0)
+        args = [_parse_int(arg) for arg in parts[1:]]
         
-        if mnemonic == 'LOADC':
-            if len(args) != 3:
-                print(f"Ошибка строки {line_num}: LOADC требует 3 аргумента")
-                continue
-                
-            const, _, dest = args
-            A = 1
-            B = const
-            C = dest
-            
-            word = (A << 26) | (B << 6) | C
-            binary.extend(struct.pack('<I', word))
-            
-            if test_mode:
-                hex_bytes = ' '.join(f'{b:02X}' for b in struct.pack('<I', word))
-                print(f"[{line_num}] LOADC: R{dest} = {const} → {hex_bytes}")
-            
-        elif mnemonic == 'READM':
-            if len(args) != 4:
-                print(f"Ошибка строки {line_num}: READM требует 4 аргумента")
-                continue
-                
-            offset, src, dest, base = args
-            A = 21
-            B = offset
-            C = dest
-            D = base
-            
-            byte1 = (A << 2) | (B >> 7)
-            byte2 = ((B & 0x7F) << 1) | (C >> 2)
-            byte3 = ((C & 0x03) << 6) | (D << 3)
-            
-            binary.extend([byte1, byte2, byte3])
-            
-            if test_mode:
-                hex_bytes = f'{byte1:02X} {byte2:02X} {byte3:02X}'
-                print(f"[{line_num}] READM: R{dest} = mem[R{base}+{offset}] → {hex_bytes}")
-            
-        elif mnemonic == 'WRITEM':
-            if len(args) != 3:
-                print(f"Ошибка строки {line_num}: WRITEM требует 3 аргумента")
+        ir.append((line_num, mnemonic, args))
+    
+    # Проход 2: свёртка констант
+    ir = _optimize(ir)
+    
+    # Проход 3: кодирование
+    # Самая длинная команда (LOADC) занимает 4 байта
+    binary = bytearray(len(ir) * 4)
+    pos = 0
+    # Диагностика копится и выводится одним вызовом после прохода,
+    # в том числе если кодировщик выбросил исключение
+    out = []
+    
+    try:
+        for line_num, mnemonic, args in ir:
+            entry = _ENCODERS.get(mnemonic)
+            if entry is None:
+                out.append(f"Неизвестная команда в строке {line_num}: {mnemonic}")
+                errors += 1
                 continue
-                
-            src, dest, base = args
-            A = 39
-            B = src
-            C = base
-            
-            byte1 = (A << 2) | (B >> 1)
-            byte2 = ((B & 0x01) << 7) | (C << 4)
             
-            binary.extend([byte1, byte2])
-            
-            if test_mode:
-                hex_bytes = f'{byte1:02X} {byte2:02X}'
-                print(f"[{line_num}] WRITEM: mem[R{base}] = R{src} → {hex_bytes}")
-            
-        elif mnemonic == 'POPCNT':
-            if len(args) != 3:
-                print(f"Ошибка строки {line_num}: POPCNT требует 3 аргумента")
+            nargs, encode, describe = entry
+            if len(args) != nargs:
+                out.append(f"Ошибка строки {line_num}: {mnemonic} требует {nargs} аргумента")
+                errors += 1
                 continue
-                
-            src, dest, base = args
-            A = 44
-            B = src
-            C = base
-            
-            byte1 = (A << 2) | (B >> 1)
-            byte2 = ((B & 0x01) << 7) | (C << 4)
             
-            binary.extend([byte1, byte2])
+            size = encode(binary, pos, args)
             
             if test_mode:
-                hex_bytes = f'{byte1:02X} {byte2:02X}'
-                print(f"[{line_num}] POPCNT: R{base} = popcount(R{src}) → {hex_bytes}")
+                hex_bytes = ' '.join(f'{b:02X}' for b in binary[pos:pos+size])
+                out.append(f"[{line_num}] {describe(args)} → {hex_bytes}")
             
-        else:
-            print(f"Неизвестная команда в строке {line_num}: {mnemonic}")
+            pos += size
+    finally:
+        if out:
+            print('\n'.join(out))
+    
+    del binary[pos:]
     
     with open(output_file, 'wb') as f:
         f.write(binary)
     
     print(f"\nСоздан файл: {output_file} ({len(binary)} байт)")
     
+    # Исходники с ошибками не кэшируются, чтобы сообщения выводились каждый раз
+    if cache_path and not errors:
+        _store_cache(cache_path, binary)
+    
     if test_mode:
-        print("\nШестнадцатеричный дамп:")
+        dump = ["\nШестнадцатеричный дамп:"]
         for i in range(0, len(binary), 16):
             chunk = binary[i:i+16]
             hex_str = ' '.join(f'{b:02X}' for b in chunk)
-            print(f"{i:04X}: {hex_str}")
+            dump.append(f"{i:04X}: {hex_str}")
+        print('\n'.join(dump))
 
 def main():
     if len(sys.argv) < 3:
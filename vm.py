@@ -2,22 +2,119 @@
 import sys
 import struct
 import csv
+from array import array
+
+MAX_STEPS = 1000
+
+_U32 = struct.Struct('<I')
+
+# Колонки Hex и Char дампа для каждого значения байта
+_HEX = [f"0x{i:02X}" for i in range(256)]
+_CHR = [chr(i) if 32 <= i < 127 else '.' for i in range(256)]
+
+# popcount для значений байта (результаты READM всегда в этом диапазоне)
+_POP8 = bytes(bin(i).count('1') for i in range(256))
+
+
+def _run_core(memory, registers, pc, max_steps):
+    """Цикл выборки-исполнения над сырой памятью для компиляции numba.
+
+    Без numba работает и как обычная функция Python, что используется
+    в test_core для сверки с интерпретатором.
+
+    Возвращает (pc, steps, A), где A — код неизвестной команды
+    или -1, если выполнение остановилось штатно.
+    """
+    n = len(memory)
+    steps = 0
+    while steps < max_steps:
+        if pc >= n:
+            break
+        b1 = memory[pc]
+        A = (b1 >> 2) & 0x3F
+        
+        if A == 1:  # LOADC
+            if pc + 4 > n:
+                break
+            word = (b1 | (memory[pc+1] << 8) | (memory[pc+2] << 16)
+                    | (memory[pc+3] << 24))
+            registers[word & 0x07] = (word >> 6) & 0xFFFFF
+            pc += 4
+        elif A == 21:  # READM
+            if pc + 3 > n:
+                break
+            b2 = memory[pc+1]
+            b3 = memory[pc+2]
+            B = ((b1 & 0x03) << 7) | ((b2 >> 1) & 0x7F)
+            C = ((b2 & 0x01) << 2) | ((b3 >> 6) & 0x03)
+            D = (b3 >> 3) & 0x07
+            addr = registers[D] + B
+            if 0 <= addr < n:
+                registers[C] = memory[addr]
+            else:
+                registers[C] = 0
+            pc += 3
+        elif A == 39 or A == 44:  # WRITEM, POPCNT
+            if pc + 2 > n:
+                break
+            b2 = memory[pc+1]
+            B = ((b1 & 0x03) << 1) | ((b2 >> 7) & 0x01)
+            C = (b2 >> 4) & 0x07
+            if A == 39:
+                addr = registers[C]
+                if 0 <= addr < n:
+                    memory[addr] = registers[B] & 0xFF
+            else:
+                value = abs(registers[B])
+                count = 0
+                while value:
+                    value &= value - 1
+                    count += 1
+                registers[C] = count
+            pc += 2
+        else:
+            return pc, steps, A
+        steps += 1
+    return pc, steps, -1
+
+
+_native = None
+
+def _load_native():
+    """Компилирует _run_core через numba; None, если numba не установлена"""
+    global _native
+    if _native is None:
+        try:
+            import numpy as np
+            from numba import njit
+        except ImportError:  # numba не обязательна: без неё работает интерпретатор на Python
+            _native = False
+        else:
+            _native = (njit(cache=True)(_run_core), np)
+    return _native or None
+
 
 class UVM:
     def __init__(self, mem_size=1024):
-        self.memory = [0] * mem_size
-        self.registers = [0] * 8
+        self.memory = bytearray(mem_size)
+        self.registers = array('i', [0] * 8)
         self.pc = 0
         self.halted = False
+        # A -> обработчик команды
+        self._dispatch = {
+            1: self._exec_loadc,    # LOADC
+            21: self._exec_readm,   # READM
+            39: self._exec_writem,  # WRITEM
+            44: self._exec_popcnt,  # POPCNT
+        }
     
     def load_binary(self, filename):
         try:
             with open(filename, 'rb') as f:
                 data = f.read()
             
-            for i, byte in enumerate(data):
-                if i < len(self.memory):
-                    self.memory[i] = byte
+            size = min(len(data), len(self.memory))
+            self.memory[:size] = data[:size]
             
             print(f"Загружено {len(data)} байт из {filename}")
             return True
@@ -29,110 +126,148 @@ class UVM:
     def step(self):
         if self.halted or self.pc >= len(self.memory):
             return False
-            
-        opcode = self.memory[self.pc]
-        A = (opcode >> 2) & 0x3F
         
-        if A == 1:  # LOADC
-            return self._exec_loadc()
-        elif A == 21:  # READM
-            return self._exec_readm()
-        elif A == 39:  # WRITEM
-            return self._exec_writem()
-        elif A == 44:  # POPCNT
-            return self._exec_popcnt()
-        else:
-            print(f"Неизвестная команда A={A} по адресу {self.pc}")
-            self.halted = True
+        A = (self.memory[self.pc] >> 2) & 0x3F
+        handler = self._dispatch.get(A)
+        if handler is None:
+            self._illegal(A, self.pc)
             return False
-    
-    def _exec_loadc(self):
-        if self.pc + 4 > len(self.memory):
+        
+        pc = handler(self.memory, len(self.memory), self.registers, self.pc)
+        if pc < 0:
             return False
-            
-        data = bytes(self.memory[self.pc:self.pc+4])
-        word = struct.unpack('<I', data)[0]
         
-        A = (word >> 26) & 0x3F
+        self.pc = pc
+        return True
+    
+    def _illegal(self, A, pc):
+        print(f"Неизвестная команда A={A} по адресу {pc}")
+        self.halted = True
+    
+    # Обработчики получают память, её размер, регистры и PC явно, чтобы
+    # не обращаться к self, и возвращают PC следующей команды
+    # (-1, если команда не помещается в память)
+    @staticmethod
+    def _exec_loadc(memory, mlen, registers, pc):
+        if pc + 4 > mlen:
+            return -1
+        
+        word = _U32.unpack_from(memory, pc)[0]
         B = (word >> 6) & 0xFFFFF
         C = word & 0x07
         
-        self.registers[C] = B
-        # print(f"[{self.pc}] LOADC: R{C} = {B}")
-        
-        self.pc += 4
-        return True
+        registers[C] = B
+        # print(f"[{pc}] LOADC: R{C} = {B}")
+        return pc + 4
     
-    def _exec_readm(self):
-        if self.pc + 3 > len(self.memory):
-            return False
-            
-        b1, b2, b3 = self.memory[self.pc:self.pc+3]
+    @staticmethod
+    def _exec_readm(memory, mlen, registers, pc):
+        if pc + 3 > mlen:
+            return -1
         
-        A = (b1 >> 2) & 0x3F
+        b1 = memory[pc]
+        b2 = memory[pc+1]
+        b3 = memory[pc+2]
         B = ((b1 & 0x03) << 7) | ((b2 >> 1) & 0x7F)
         C = ((b2 & 0x01) << 2) | ((b3 >> 6) & 0x03)
         D = (b3 >> 3) & 0x07
         
-        addr = self.registers[D] + B
-        if 0 <= addr < len(self.memory):
-            value = self.memory[addr]
+        addr = registers[D] + B
+        if 0 <= addr < mlen:
+            value = memory[addr]
         else:
             value = 0
             
-        self.registers[C] = value
-        # print(f"[{self.pc}] READM: R{C} = mem[R{D}+{B}=0x{addr:X}] = {value}")
-        
-        self.pc += 3
-        return True
+        registers[C] = value
+        # print(f"[{pc}] READM: R{C} = mem[R{D}+{B}=0x{addr:X}] = {value}")
+        return pc + 3
     
-    def _exec_writem(self):
-        if self.pc + 2 > len(self.memory):
-            return False
-            
-        b1, b2 = self.memory[self.pc:self.pc+2]
+    @staticmethod
+    def _exec_writem(memory, mlen, registers, pc):
+        if pc + 2 > mlen:
+            return -1
         
-        A = (b1 >> 2) & 0x3F
+        b1 = memory[pc]
+        b2 = memory[pc+1]
         B = ((b1 & 0x03) << 1) | ((b2 >> 7) & 0x01)
         C = (b2 >> 4) & 0x07
         
-        addr = self.registers[C]
-        value = self.registers[B] & 0xFF
+        addr = registers[C]
+        value = registers[B] & 0xFF
         
-        if 0 <= addr < len(self.memory):
-            self.memory[addr] = value
+        if 0 <= addr < mlen:
+            memory[addr] = value
             
-        # print(f"[{self.pc}] WRITEM: mem[R{C}=0x{addr:X}] = R{B} = {value}")
-        
-        self.pc += 2
-        return True
+        # print(f"[{pc}] WRITEM: mem[R{C}=0x{addr:X}] = R{B} = {value}")
+        return pc + 2
     
-    def _exec_popcnt(self):
-        if self.pc + 2 > len(self.memory):
-            return False
-            
-        b1, b2 = self.memory[self.pc:self.pc+2]
+    @staticmethod
+    def _exec_popcnt(memory, mlen, registers, pc):
+        if pc + 2 > mlen:
+            return -1
         
-        A = (b1 >> 2) & 0x3F
+        b1 = memory[pc]
+        b2 = memory[pc+1]
         B = ((b1 & 0x03) << 1) | ((b2 >> 7) & 0x01)
         C = (b2 >> 4) & 0x07
         
-        value = self.registers[B]
-        popcnt_val = bin(value).count('1')
+        value = registers[B]
+        if 0 <= value < 256:
+            popcnt_val = _POP8[value]
+        else:
+            popcnt_val = value.bit_count()
         
-        self.registers[C] = popcnt_val
-        # print(f"[{self.pc}] POPCNT: R{C} = popcount(R{B}=0x{value:X}) = {popcnt_val}")
+        registers[C] = popcnt_val
+        # print(f"[{pc}] POPCNT: R{C} = popcount(R{B}=0x{value:X}) = {popcnt_val}")
+        return pc + 2
+    
+    def _run_native(self, native):
+        core, np = native
+        registers = np.array(self.registers, dtype=np.int64)
+        memory = np.frombuffer(self.memory, dtype=np.uint8)
+        pc, steps, A = core(memory, registers, self.pc, MAX_STEPS)
         
-        self.pc += 2
-        return True
+        self.registers[:] = array('i', registers.tolist())
+        self.pc = pc
+        if A >= 0:
+            self._illegal(A, pc)
+        return steps
     
-    def run(self):
+    def _run_python(self):
+        # Переходов в системе команд нет, каждая команда выполняется не более
+        # одного раза, поэтому декодирование идёт прямо в цикле исполнения
+        memory = self.memory
+        mlen = len(memory)
+        registers = self.registers
+        dispatch = self._dispatch
+        pc = self.pc
+        
         steps = 0
-        while not self.halted and steps < 1000:
-            if not self.step():
+        while steps < MAX_STEPS and pc < mlen:
+            A = (memory[pc] >> 2) & 0x3F
+            handler = dispatch.get(A)
+            if handler is None:
+                self._illegal(A, pc)
+                break
+            next_pc = handler(memory, mlen, registers, pc)
+            if next_pc < 0:
                 break
+            pc = next_pc
             steps += 1
         
+        self.pc = pc
+        return steps
+    
+    def run(self, native=False):
+        # numba подключается только по явному запросу: при MAX_STEPS шагах
+        # её импорт и компиляция дороже, чем цикл на Python
+        if self.halted:
+            steps = 0
+        elif native and (core := _load_native()) is not None:
+            steps = self._run_native(core)
+        else:
+            steps = self._run_python()
+        
         print(f"\nПрограмма выполнена за {steps} шагов")
         self.show_registers()
     
@@ -143,15 +278,17 @@ class UVM:
     
     def dump_csv(self, filename, start, end):
         try:
-            with open(filename, 'w', newline='') as f:
+            # Буфер 1 МиБ: дамп уходит на диск крупными блоками
+            with open(filename, 'w', newline='', buffering=1 << 20) as f:
                 writer = csv.writer(f)
                 writer.writerow(['Address', 'Value', 'Hex', 'Char'])
                 
-                for addr in range(start, min(end, len(self.memory))):
-                    val = self.memory[addr]
-                    hex_val = f"0x{val:02X}"
-                    char = chr(val) if 32 <= val < 127 else '.'
-                    writer.writerow([addr, val, hex_val, char])
+                start = max(start, 0)
+                end = min(max(end, start), len(self.memory))
+                writer.writerows(
+                    [addr, val, _HEX[val], _CHR[val]]
+                    for addr, val in enumerate(self.memory[start:end], start)
+                )
             
             print(f"Дамп памяти сохранен в {filename}")
         except Exception as e:
@@ -166,16 +303,17 @@ class UVM:
         src_addr = 0x100
         dst_addr = 0x200
         
+        n = len(source)
+        
         # Записываем исходный массив
-        for i, val in enumerate(source):
-            self.memory[src_addr + i] = val
+        self.memory[src_addr:src_addr+n] = bytes(source)
         
         # Копируем вручную (в реальности должна быть программа)
-        for i in range(len(source)):
-            self.memory[dst_addr + i] = self.memory[src_addr + i]
+        with memoryview(self.memory) as mem:
+            mem[dst_addr:dst_addr+n] = mem[src_addr:src_addr+n]
         
-        print(f"Исходный массив по адресу 0x{src_addr:04X}: {self.memory[src_addr:src_addr+5]}")
-        print(f"Скопирован в 0x{dst_addr:04X}: {self.memory[dst_addr:dst_addr+5]}")
+        print(f"Исходный массив по адресу 0x{src_addr:04X}: {list(self.memory[src_addr:src_addr+5])}")
+        print(f"Скопирован в 0x{dst_addr:04X}: {list(self.memory[dst_addr:dst_addr+5])}")
         print("Тест завершен ✓")
     
     def test_popcnt(self):
@@ -194,7 +332,7 @@ class UVM:
         all_ok = True
         for value, expected in test_cases:
             self.registers[0] = value
-            result = bin(value).count('1')
+            result = value.bit_count()
             ok = (result == expected)
             all_ok = all_ok and ok
             print(f"  0x{value:04X}: popcount = {result}, ожидалось {expected} {'✓' if ok else '✗'}")
@@ -203,15 +341,60 @@ class UVM:
             print("Все тесты пройдены ✓")
         else:
             print("Некоторые тесты не пройдены")
+    
+    def test_core(self):
+        """Сверка ядра _run_core с интерпретатором на одной программе"""
+        print("\n=== ТЕСТ ЯДРА ===")
+        
+        program = bytes([
+            0x9E, 0x30,              # WRITEM: mem[R3] = R4
+            0x54, 0xA1, 0x50,        # READM:  R5 = mem[R2+0x50]
+            0xB3, 0x70,              # POPCNT: R7 = popcount(R6)
+            0x05, 0x02, 0x00, 0x04,  # LOADC:  R5 = 8
+            0x9C, 0x10,              # WRITEM: mem[R1] = R0 (адрес 13)
+            0x00, 0x70,              # после записи: POPCNT R7 = popcount(R6)
+        ])
+        registers = [0xB3, 13, 0x100, 0x150, 123, 0, 0xFF0F, 0]
+        initial = bytearray(self.memory)
+        initial[:len(program)] = program
+        
+        self.memory[:] = initial
+        self.registers[:] = array('i', registers)
+        self.pc = 0
+        self.halted = False
+        steps = self._run_python()
+        expected = (list(self.registers), bytes(self.memory), steps, self.pc)
+        
+        cores = [('Python', _run_core, bytearray(initial), list(registers))]
+        native = _load_native()
+        if native is not None:
+            core, np = native
+            cores.append(('numba', core,
+                          np.frombuffer(bytearray(initial), dtype=np.uint8),
+                          np.array(registers, dtype=np.int64)))
+        
+        all_ok = True
+        for name, core, memory, core_regs in cores:
+            pc, core_steps, A = core(memory, core_regs, 0, MAX_STEPS)
+            result = ([int(r) for r in core_regs], bytes(memory), core_steps, pc)
+            ok = result == expected and (A >= 0) == self.halted
+            all_ok = all_ok and ok
+            print(f"  {name}: {core_steps} шагов, PC={pc} {'✓' if ok else '✗'}")
+        
+        if all_ok:
+            print("Все тесты пройдены ✓")
+        else:
+            print("Некоторые тесты не пройдены")
 
 def main():
     print("=== ИНТЕРПРЕТАТОР УВМ (Вариант 10) ===\n")
     
     if len(sys.argv) < 2:
         print("Использование:")
-        print("  1. Запуск программы: python vm.py run <program.bin> <dump.csv> <start> <end>")
+        print("  1. Запуск программы: python vm.py run <program.bin> <dump.csv> <start> <end> [native]")
         print("  2. Тест POPCNT:      python vm.py test_popcnt")
         print("  3. Тест массива:     python vm.py test_array")
+        print("  4. Тест ядра:        python vm.py test_core")
         print("\nПример:")
         print("  python vm.py run program.bin dump.csv 0 100")
         print("  python vm.py test_popcnt")
@@ -220,16 +403,17 @@ def main():
     
     mode = sys.argv[1]
     
-    if mode == 'run' and len(sys.argv) == 6:
-        # python vm.py run program.bin dump.csv 0 100
+    if mode == 'run' and len(sys.argv) in (6, 7):
+        # python vm.py run program.bin dump.csv 0 100 [native]
         program_file = sys.argv[2]
         dump_file = sys.argv[3]
         start = int(sys.argv[4])  # 0
         end = int(sys.argv[5])    # 100
+        native = len(sys.argv) == 7 and sys.argv[6].lower() == 'native'
         
         vm = UVM()
         if vm.load_binary(program_file):
-            vm.run()
+            vm.run(native=native)
             vm.dump_csv(dump_file, start, end)
     
     elif mode == 'test_popcnt':
@@ -241,6 +425,10 @@ def main():
         vm.test_array_copy()
         vm.dump_csv('array_test.csv', 0x100, 0x210)
     
+    elif mode == 'test_core':
+        vm = UVM()
+        vm.test_core()
+    
     else:
         print("Неверные аргументы. Используйте:")
         print("  python vm.py help")